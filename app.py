@@ -1,20 +1,25 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from marketplace_standard_app_api.models.transformation import (
-    TransformationCreateResponse,
     TransformationId,
     TransformationListResponse,
     TransformationModel,
     TransformationState,
-    TransformationStateResponse,
     TransformationUpdateModel,
     TransformationUpdateResponse,
 )
 from marketplace_standard_app_api.routers import object_storage
 
-from models.transformation import TransformationInput
-from simulation_controller.simulation_manager import SimulationManager
+from models.transformation import (
+    EstimatedTransformationCreateResponse,
+    EstimatedTransformationStateResponse,
+    TransformationInput,
+)
+from simulation_controller.simulation_manager import (
+    QueueFullError,
+    SimulationManager,
+)
 
 app = FastAPI()
 
@@ -23,6 +28,18 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 simulation_manager = SimulationManager()
 
 
+@app.on_event("startup")
+def start_simulation_manager():
+    """Join the workers that claim and run simulations."""
+    simulation_manager.start()
+
+
+@app.on_event("shutdown")
+def stop_simulation_manager():
+    """Hand the simulations running in this worker back to the others."""
+    simulation_manager.shutdown()
+
+
 @app.get(
     path="/health",
     summary="Check if application is running.",
@@ -36,14 +53,25 @@ def heartbeat():
     "/transformations",
     operation_id="newTransformation",
     summary="Create a new transformation",
-    response_model=TransformationCreateResponse,
+    response_model=EstimatedTransformationCreateResponse,
+    responses={429: {"description": "Too many queued simulations"}},
 )
-async def create_transformation(
+def create_transformation(
     payload: TransformationInput,
-) -> TransformationCreateResponse:
+) -> EstimatedTransformationCreateResponse:
     """Create a new transformation."""
-    id = simulation_manager.create_simulation(payload)
-    return {"id": id}
+    try:
+        id = simulation_manager.create_simulation(payload)
+    except QueueFullError as qe:
+        raise HTTPException(
+            status_code=429,
+            detail=str(qe),
+            headers={"Retry-After": str(qe.retry_after)},
+        ) from qe
+    return {
+        "id": id,
+        "predictedCompletion": simulation_manager.get_predicted_completion(id),
+    }
 
 
 @app.get(
@@ -73,6 +101,7 @@ def get_simulation(transformation_id: TransformationId):
     responses={
         404: {"description": "Not Found."},
         409: {"description": "Requested state not available"},
+        429: {"description": "Too many queued simulations"},
         400: {"description": "Error executing update operation"},
     },
 )
@@ -107,6 +136,12 @@ def update_simulation(
         ) from ke
     except RuntimeError as re:
         raise HTTPException(status_code=409, detail="Runtime error") from re
+    except QueueFullError as qe:
+        raise HTTPException(
+            status_code=429,
+            detail=str(qe),
+            headers={"Retry-After": str(qe.retry_after)},
+        ) from qe
     except Exception as e:
         msg = f"Unexpected error while changing state of simulation \
                 {transformation_id}. Error message: {e}"
@@ -117,23 +152,31 @@ def update_simulation(
     "/transformations/{transformation_id}/state",
     operation_id="getTransformationState",
     summary="Get the state of the simulation.",
-    response_model=TransformationStateResponse,
+    response_model=EstimatedTransformationStateResponse,
     responses={404: {"description": "Unknown simulation"}},
 )
 def get_simulation_state(
     transformation_id: TransformationId,
-) -> TransformationStateResponse:
+) -> EstimatedTransformationStateResponse:
     """Get the state of a simulation.
 
     Args:
         transformation_id (TransformationId): ID of the simulation
 
     Returns:
-        TransformationStateResponse: The state of the simulation.
+        EstimatedTransformationStateResponse: The state of the simulation and
+            its predicted completion time.
     """
     try:
         state = simulation_manager.get_simulation_state(str(transformation_id))
-        return {"id": transformation_id, "state": state}
+        predicted_completion = simulation_manager.get_predicted_completion(
+            str(transformation_id)
+        )
+        return {
+            "id": transformation_id,
+            "state": state,
+            "predictedCompletion": predicted_completion,
+        }
 
     except KeyError as ke:
         raise HTTPException(
@@ -160,8 +203,11 @@ def get_simulations() -> TransformationListResponse:
         TransformationListResponse: List of simulations.
     """
     try:
-        items = simulation_manager.get_simulations()
-        return {"items": items}
+        # The manager keeps each simulation serialized until it changes
+        return StreamingResponse(
+            simulation_manager.iter_simulations_json(),
+            media_type="application/json",
+        )
     except Exception as e:
         msg = (
             "Unexpected error while fetching the list of simulations. "
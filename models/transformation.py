@@ -1,9 +1,12 @@
+from datetime import datetime
 from enum import Enum
 from typing import List, Optional
 
 from marketplace_standard_app_api.models.transformation import (
+    TransformationCreateResponse,
     TransformationId,
     TransformationState,
+    TransformationStateResponse,
 )
 from pydantic import BaseModel, validator
 
@@ -65,3 +68,11 @@ class TransformationModel(BaseModel):
 
 class TransformationListResponse(BaseModel):
     items: Optional[List[TransformationId]]
+
+
+class EstimatedTransformationCreateResponse(TransformationCreateResponse):
+    predictedCompletion: Optional[datetime] = None
+
+
+class EstimatedTransformationStateResponse(TransformationStateResponse):
+    predictedCompletion: Optional[datetime] = None
@@ -1,11 +1,14 @@
 """Defines the basic functions to run MatCalc calculations."""
 
 import os
+import signal
 import string
 import subprocess
+import threading
+import time
 import zipfile
 from enum import Enum
-from multiprocessing import Process
+from multiprocessing import Array, Process
 from pathlib import Path
 
 import matplotlib
@@ -14,11 +17,24 @@ import numpy as np
 
 from models.transformation import TransformationInput
 
+from .workspace import Workspace
+
 matplotlib.use("Agg")
 
 
 MATCALC_PATH = Path("/opt/matcalc/")
 TEMPLATES_FOLDER_PATH = "/root/app/simulation_controller/templates"
+PHASES = (
+    "LIQUID",
+    "FCC_A1",
+    "BCC_A2",
+    "CEMENTITE",
+    "M23C6",
+    "M7C3",
+    "M6C",
+    "LAVES_PHASE",
+)
+PARENT_POLL_INTERVAL = 1.0
 
 
 class Calculation(Enum):
@@ -29,23 +45,34 @@ class Calculation(Enum):
     SCHEIL = "scheil"
 
 
+def _raise_system_exit(signum, frame):
+    """Turn a termination request into an exception so cleanup runs."""
+    raise SystemExit(128 + signum)
+
+
+def _watch_parent(parent_pid: int):
+    """Terminate the current process once its parent has died.
+
+    The parent death signal of prctl is not used because it fires when the
+    forking thread exits, which may be any request thread of the API.
+
+    Args:
+        parent_pid (int): process id of the parent
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(PARENT_POLL_INTERVAL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
 class MatCalcProcess(Process):
     def __init__(self, process_input: TransformationInput, output_path: Path):
-        os.chdir(str(output_path))
         super().__init__()
         self.elements = process_input.elements
-        self.exit_code = None
-        self.phases = [
-            "LIQUID",
-            "FCC_A1",
-            "BCC_A2",
-            "CEMENTITE",
-            "M23C6",
-            "M7C3",
-            "M6C",
-            "LAVES_PHASE",
-        ]
+        self.phases = list(PHASES)
         self.output_path = output_path
+        self.parent_pid = os.getpid()
+        # Wall time of each calculation, shared with the parent process
+        self.stage_runtimes = Array("d", len(Calculation))
         self.substitutes = {
             "third": self.elements[1].element.value,
             "c_third": self.elements[1].weightPercentage,
@@ -53,17 +80,40 @@ class MatCalcProcess(Process):
         }
 
     def run(self):
-        files_equilibrium = self.equilibrium_calculation()
-        files_scheil = self.scheil_calculation()
-
-        # Write all files to a zip archive and delete them
-        with zipfile.ZipFile(self.output_path / "results.zip", mode="w") as zf:
-            for file in (*files_equilibrium, *files_scheil):
-                zf.write(file)
-                os.remove(file)
+        # Stopping a simulation terminates this process; unwind through the
+        # workspace so its scratch directory is removed as well
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+        # Exit with a killed worker: its jobs are claimed again once their
+        # leases expire and must not keep running here at the same time
+        threading.Thread(
+            target=_watch_parent, args=(self.parent_pid,), daemon=True
+        ).start()
+
+        with Workspace(self.output_path) as workspace:
+            start = time.perf_counter()
+            files_equilibrium = self.equilibrium_calculation(workspace.path)
+            self.stage_runtimes[0] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            files_scheil = self.scheil_calculation(workspace.path)
+            self.stage_runtimes[1] = time.perf_counter() - start
+
+            # Write all files to a zip archive and keep only the archive
+            archive = workspace.path / "results.zip"
+            with zipfile.ZipFile(archive, mode="w") as zf:
+                for file in (*files_equilibrium, *files_scheil):
+                    zf.write(file, arcname=file.name)
+            workspace.promote(archive)
         return subprocess.CompletedProcess(args=self.elements, returncode=0)
 
-    def equilibrium_calculation(self):
+    def get_stage_runtimes(self) -> dict:
+        """Return the wall time in seconds of each calculation."""
+        return {
+            str(calculation): runtime
+            for calculation, runtime in zip(Calculation, self.stage_runtimes)
+        }
+
+    def equilibrium_calculation(self, workdir: Path):
         with open(
             os.path.join(TEMPLATES_FOLDER_PATH, "equilibrium.mcs"), "r"
         ) as file:
@@ -73,29 +123,30 @@ class MatCalcProcess(Process):
         script = string.Template(template).safe_substitute(self.substitutes)
 
         # Write the MatCalc script for the stepped equilibrium calculation
-        with open("equilibrium.mcs", "w") as file:
+        with open(workdir / "equilibrium.mcs", "w") as file:
             file.write(script)
 
         # Run the stepped equilibrium calculation in MatCalc
         subprocess.run(
             [MATCALC_PATH / "mcc", "equilibrium.mcs"],
             check=True,
-            stdout=open(os.devnull, "wb"),
+            cwd=workdir,
+            stdout=subprocess.DEVNULL,
         )  # 'mcc' calls the MatCalc console
 
         # Read the MatCalc results
-        results = (np.loadtxt("T_C.dat"),)
+        results = (np.loadtxt(workdir / "T_C.dat"),)
         header = "T$C".ljust(12, " ")
         fmt = ["%.6e"]
         for phase in self.phases:
-            results += (np.loadtxt("f_{}.dat".format(phase)),)
+            results += (np.loadtxt(workdir / "f_{}.dat".format(phase)),)
             label = "f$" + phase
             header += "\t" + label.ljust(12, " ")
             fmt += ["%.{0:d}e".format(max(len(label) - 6, 6))]
 
         # Write the results to one file
 
-        data_file = self.output_path / "equilibrium.dat"
+        data_file = workdir / "equilibrium.dat"
         np.savetxt(
             data_file,
             np.c_[results],
@@ -107,7 +158,7 @@ class MatCalcProcess(Process):
 
         # Plot the results and save the figure
 
-        plot_file = self.output_path / "equilibrium.png"
+        plot_file = workdir / "equilibrium.png"
         legend = []
         plt.figure(figsize=(4.0, 3.0))
         for i in range(1, len(results)):
@@ -122,19 +173,16 @@ class MatCalcProcess(Process):
         plt.savefig(plot_file, dpi=600)
         plt.close()
 
-        # Remove the MatCalc files
-        os.remove("equilibrium.mcs")
-        os.remove("T_C.dat")
-        for phase in self.phases:
-            os.remove(f"f_{phase}.dat")
-
         return (data_file, plot_file)
 
-    def scheil_calculation(self):
-        """_summary_
+    def scheil_calculation(self, workdir: Path):
+        """Run the Scheil calculation inside the given scratch directory.
 
-        Raises:
-            RuntimeError: _description_
+        Args:
+            workdir (Path): private scratch directory of the calculation
+
+        Returns:
+            tuple: paths to the data file and the plot
         """
         with open(
             os.path.join(TEMPLATES_FOLDER_PATH, "Scheil.mcs"), "r"
@@ -145,27 +193,27 @@ class MatCalcProcess(Process):
         script = string.Template(template).safe_substitute(self.substitutes)
 
         # Write the MatCalc script for the Scheil calculation
-        with open("Scheil.mcs", "w") as file:
+        with open(workdir / "Scheil.mcs", "w") as file:
             file.write(script)
 
         # Run the Scheil calculation in MatCalc
         subprocess.run(
-            [MATCALC_PATH / "mcc", "Scheil.mcs"], check=True
+            [MATCALC_PATH / "mcc", "Scheil.mcs"], check=True, cwd=workdir
         )  # 'mcc' calls the MatCalc console
 
         # Read the MatCalc results
-        results = (np.loadtxt("T_C.dat"),)
+        results = (np.loadtxt(workdir / "T_C.dat"),)
         header = "T$C".ljust(12, " ")
         fmt = ["%.6e"]
         for phase in self.phases:
-            results += (np.loadtxt("f_{}_S.dat".format(phase)),)
+            results += (np.loadtxt(workdir / "f_{}_S.dat".format(phase)),)
             label = "f$" + phase
             header += "\t" + label.ljust(12, " ")
             fmt += ["%.{0:d}e".format(max(len(label) - 6, 6))]
 
         # Write the results to one file
 
-        data_file = self.output_path / "Scheil.dat"
+        data_file = workdir / "Scheil.dat"
         np.savetxt(
             data_file,
             np.c_[results],
@@ -177,7 +225,7 @@ class MatCalcProcess(Process):
 
         # Plot the results and save the figure
 
-        plot_file = self.output_path / "Scheil.png"
+        plot_file = workdir / "Scheil.png"
         legend = []
         plt.figure(figsize=(4.0, 3.0))
         for i in range(1, len(results)):
@@ -192,10 +240,4 @@ class MatCalcProcess(Process):
         plt.savefig(plot_file, dpi=600)
         plt.close()
 
-        # Remove the MatCalc files
-        os.remove("Scheil.mcs")
-        os.remove("T_C.dat")
-        for phase in self.phases:
-            os.remove("f_{}_S.dat".format(phase))
-
         return (data_file, plot_file)
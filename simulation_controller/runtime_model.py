@@ -0,0 +1,114 @@
+"""Prediction of the runtime of MatCalc simulations."""
+
+from typing import Sequence
+
+import numpy as np
+
+from models.transformation import AllowedElements
+
+from .matcalc_process import Calculation
+
+DEFAULT_STAGE_RUNTIME = 60.0
+MIN_SAMPLES = 5
+RIDGE_PENALTY = 1e-3
+
+ALLOYING_ELEMENTS = [
+    element for element in AllowedElements if element != AllowedElements.C
+]
+
+
+class RuntimePredictor:
+    """Linear model of the runtime of each calculation of a simulation.
+
+    Every calculation gets its own ridge regression on the carbon content,
+    the content and kind of the alloying element and the number of phases.
+    Until enough runs have been recorded, the mean observed runtime, or
+    DEFAULT_STAGE_RUNTIME if there is none, is predicted instead.
+    """
+
+    def __init__(self):
+        # Coefficients, means and floors per calculation. They are replaced
+        # together so that a concurrent prediction never mixes two fits.
+        self._model: tuple = (
+            {},
+            {str(stage): DEFAULT_STAGE_RUNTIME for stage in Calculation},
+            {str(stage): 0.0 for stage in Calculation},
+        )
+
+    @staticmethod
+    def _features(parameters: dict, phases: Sequence[str]) -> np.ndarray:
+        """Encode the input of a simulation as a feature vector.
+
+        Args:
+            parameters (dict): serialized TransformationInput
+            phases (Sequence[str]): phases selected for the calculation
+
+        Returns:
+            np.ndarray: feature vector, starting with the intercept
+        """
+        carbon, alloy = parameters["elements"]
+        return np.array(
+            [
+                1.0,
+                carbon["weightPercentage"],
+                alloy["weightPercentage"],
+                len(phases),
+                *(
+                    float(alloy["element"] == element.value)
+                    for element in ALLOYING_ELEMENTS
+                ),
+            ]
+        )
+
+    def fit(self, samples: Sequence[dict]):
+        """Fit the model to recorded runs.
+
+        Args:
+            samples (Sequence[dict]): runs with their `parameters`, `phases`
+                and the `runtimes` in seconds of each calculation
+        """
+        coefficients = {}
+        means = {str(stage): DEFAULT_STAGE_RUNTIME for stage in Calculation}
+        floors = {str(stage): 0.0 for stage in Calculation}
+        if not samples:
+            self._model = (coefficients, means, floors)
+            return
+        features = np.array(
+            [
+                self._features(sample["parameters"], sample["phases"])
+                for sample in samples
+            ]
+        )
+        penalty = RIDGE_PENALTY * np.eye(features.shape[1])
+        for stage in map(str, Calculation):
+            runtimes = np.array(
+                [sample["runtimes"][stage] for sample in samples]
+            )
+            means[stage] = float(runtimes.mean())
+            floors[stage] = float(runtimes.min())
+            if len(samples) >= MIN_SAMPLES:
+                coefficients[stage] = np.linalg.solve(
+                    features.T @ features + penalty, features.T @ runtimes
+                )
+        self._model = (coefficients, means, floors)
+
+    def predict(self, parameters: dict, phases: Sequence[str]) -> float:
+        """Predict the total runtime of a simulation.
+
+        Args:
+            parameters (dict): serialized TransformationInput
+            phases (Sequence[str]): phases selected for the calculation
+
+        Returns:
+            float: predicted runtime in seconds
+        """
+        coefficients, means, floors = self._model
+        features = self._features(parameters, phases)
+        runtime = 0.0
+        for stage in map(str, Calculation):
+            if stage not in coefficients:
+                runtime += means[stage]
+            else:
+                prediction = float(features @ coefficients[stage])
+                runtime += max(prediction, floors[stage])
+        return runtime
@@ -1,7 +1,7 @@
 import logging
-import shutil
 import uuid
 from pathlib import Path
+from typing import Optional
 
 from marketplace_standard_app_api.models.transformation import (
     TransformationState,
@@ -13,16 +13,29 @@ from .matcalc_process import MatCalcProcess
 
 SIMULATIONS_FOLDER_PATH = "/root/app/simulation_files"
 
+FINISHED_STATES = frozenset(
+    (
+        TransformationState.COMPLETED,
+        TransformationState.FAILED,
+        TransformationState.STOPPED,
+    )
+)
+
 
 class Simulation:
     """Manage a single simulation."""
 
-    def __init__(self, simulation_input: TransformationInput):
-        self.id: str = str(uuid.uuid4())
+    def __init__(
+        self, simulation_input: TransformationInput, id: Optional[str] = None
+    ):
+        self.id: str = id or str(uuid.uuid4())
         self.parameters = simulation_input
         self.simulationPath = Path(SIMULATIONS_FOLDER_PATH, self.id)
-        self.simulationPath.mkdir()
+        # A simulation taken over from another worker reuses its folder
+        self.simulationPath.mkdir(exist_ok=True)
         self._process = MatCalcProcess(simulation_input, self.simulationPath)
+        self.phases: list[str] = self._process.phases
+        self.stage_runtimes: Optional[dict] = None
         logging.info(
             f"Simulation '{self.id}' with "
             f"payload {simulation_input} created."
@@ -34,25 +47,39 @@ class Simulation:
         """Getter for the status.
 
         If the simulation is running, the process is checked for completion.
+        Once it has exited, the runtime of each calculation is kept and the
+        process handle is released.
 
         Returns:
             TransformationState: status of the simulation
         """
         if self._status == TransformationState.RUNNING:
             if not self._process.is_alive():
-                return_code = self._process.exit_code
+                return_code = self._process.exitcode
                 if not return_code:
                     logging.info(f"Simulation '{self.id}' is now completed.")
                     self.status = TransformationState.COMPLETED
+                    self.stage_runtimes = self._process.get_stage_runtimes()
                 else:
                     logging.error(f"Error occurred in simulation '{self.id}'.")
                     self.status = TransformationState.FAILED
+                self._release_process()
         return self._status
 
     @status.setter
     def status(self, value: TransformationState):
         self._status = value
 
+    @property
+    def is_finished(self) -> bool:
+        """Whether the simulation reached a state it cannot leave."""
+        return self.status in FINISHED_STATES
+
+    def _release_process(self):
+        """Free the resources held by the exited MatCalc process."""
+        self._process.close()
+        self._process = None
+
     def run(self):
         """
         Start running a simulation.
@@ -62,11 +89,16 @@ class Simulation:
 
         Raises:
             RuntimeError: when the simulation is already in progress
+                or has already finished
         """
         if self.status == TransformationState.RUNNING:
             msg = f"Simulation '{self.id}' already in progress."
             logging.error(msg)
             raise RuntimeError(msg)
+        if self._process is None:
+            msg = f"Simulation '{self.id}' has already finished."
+            logging.error(msg)
+            raise RuntimeError(msg)
         self._process.start()
         self.status = TransformationState.RUNNING
         logging.info(f"Simulation '{self.id}' started successfully.")
@@ -77,31 +109,14 @@ class Simulation:
         Raises:
             RuntimeError: if the simulation is not running
         """
-        if self.process is None:
+        if self.status != TransformationState.RUNNING:
             msg = f"No process to stop. Is simulation '{self.id}' running?"
 
             logging.error(msg)
             raise RuntimeError(msg)
-        self.process.terminate()
+        # The process removes its scratch workspace on termination
+        self._process.terminate()
+        self._process.join()
+        self._release_process()
         self.status = TransformationState.STOPPED
-        self.process = None
         logging.info(f"Simulation '{self.id}' stopped successfully.")
-
-    def delete(self):
-        """
-        Delete all the simulation folders and files.
-
-        Raises:
-            RuntimeError: if deleting a running simulation
-        """
-        if self.status == TransformationState.RUNNING:
-            msg = f"Simulation '{self.id}' is running."
-            logging.error(msg)
-            raise RuntimeError(msg)
-        shutil.rmtree(self.simulationPath)
-        logging.info(f"Simulation '{self.id}' and related files deleted.")
-
-    def get_output_path(self):
-        """Return the zipped file with the simulation results."""
-        if self.status == TransformationState.COMPLETED:
-            return self.simulationPath / "results.zip"
@@ -1,54 +1,329 @@
+import json
 import logging
+import math
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+from marketplace_standard_app_api.models.transformation import (
+    TransformationState,
+)
 
 from models.transformation import TransformationInput
-from simulation_controller.simulation import Simulation
+from simulation_controller.matcalc_process import PHASES
+from simulation_controller.runtime_model import RuntimePredictor
+from simulation_controller.simulation import (
+    SIMULATIONS_FOLDER_PATH,
+    Simulation,
+)
+from simulation_controller.state_store import SimulationStore
 
+HEARTBEAT_INTERVAL = 5.0
+# Number of simulations running at once, shared by all the API workers
+MAX_SIMULATIONS = int(os.environ.get("MAX_SIMULATIONS", os.cpu_count() or 1))
+# Longest predicted wait in seconds before new work is turned away
+MAX_QUEUE_WAIT = float(os.environ.get("MAX_QUEUE_WAIT", 3600))
+RUNTIME_HISTORY = 1000
+# Simulations written per chunk of the streamed list response
+LIST_CHUNK_SIZE = 1000
+
+
+class QueueFullError(Exception):
+    """New work would wait longer than MAX_QUEUE_WAIT before running."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
 
-class SimulationManager:
-    def __init__(self):
-        self.simulations: dict[str, Simulation] = {}
 
-    def _get_simulation(self, id: str) -> Simulation:
+class SimulationManager:
+    """Front end to the simulations shared by all API workers.
+
+    Records live in a `SimulationStore`; this object only holds the
+    simulations whose MatCalc process runs in the current worker. Requesting
+    a run queues the simulation, and workers claim queued simulations through
+    leases that a background heartbeat keeps alive. The heartbeat also
+    reports finished simulations, so their new state shows up within
+    HEARTBEAT_INTERVAL.
+    """
+
+    def __init__(self, store: Optional[SimulationStore] = None):
+        self.store = store or SimulationStore()
+        self.worker_id = (
+            f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        self._running: dict[str, Simulation] = {}
+        self._lock = threading.Lock()
+        self._heartbeat: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        # Serialized simulations for the list response, see
+        # iter_simulations_json
+        self._items: dict[str, str] = {}
+        self._items_version = 0
+        self._items_lock = threading.Lock()
+        self.predictor = RuntimePredictor()
+        self._predictor_version: Optional[int] = None
+        self._predictor_lock = threading.Lock()
+        self._backlog: Optional[tuple] = None
+
+    def start(self):
+        """Start claiming simulations and renewing their leases."""
+        if self._heartbeat is not None:
+            return
+        self._stopping.clear()
+        self._heartbeat = threading.Thread(
+            target=self._heartbeat_loop,
+            name=f"heartbeat-{self.worker_id}",
+            daemon=True,
+        )
+        self._heartbeat.start()
+
+    def shutdown(self):
+        """Stop the heartbeat and hand the local simulations back.
+
+        Simulations that finished since the last heartbeat are reported
+        first. The remaining processes are terminated and their simulations
+        are released so that another worker picks them up without waiting
+        for the lease to expire.
+        """
+        self._stopping.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self._reap()
+        with self._lock:
+            ids = list(self._running)
+        for id in ids:
+            self._terminate(id)
+        self.store.release(self.worker_id, ids)
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.sync()
+            except Exception:
+                logging.exception(f"Heartbeat of '{self.worker_id}' failed.")
+
+    def sync(self):
+        """Reconcile the local processes with the shared state.
+
+        Finished simulations are reported, leases are renewed, processes of
+        simulations that were stopped or taken over elsewhere are terminated
+        and free slots are filled with queued simulations.
+
+        `self._lock` only guards the map of local simulations; database
+        writes and waiting for processes happen outside of it so that request
+        threads are never blocked behind them.
         """
-        Get the simulation corresponding to the id.
+        self._reap()
+        with self._lock:
+            ids = list(self._running)
+        held = self.store.renew(self.worker_id, ids)
+        for id in set(ids) - held:
+            logging.info(f"Simulation '{id}' is no longer held here.")
+            self._terminate(id)
+        self._claim()
+
+    def _terminate(self, id: str):
+        """Terminate the local process of a simulation, if there is one.
+
+        A process that already exited is reported instead, so that its
+        outcome is not lost.
+        """
+        with self._lock:
+            simulation = self._running.pop(id, None)
+        if simulation is None:
+            return
+        if not simulation.is_finished:
+            try:
+                simulation.stop()
+                return
+            except RuntimeError:
+                # The process exited on its own in the meantime
+                pass
+        self._report(simulation)
+
+    def _report(self, simulation: Simulation):
+        """Record the outcome of a simulation whose local process exited.
 
         Args:
-            id (str): unique id of he simulation
+            simulation (Simulation): finished simulation
+        """
+        if simulation.stage_runtimes is not None:
+            self.store.add_runtime(
+                simulation.parameters.dict(),
+                simulation.phases,
+                simulation.stage_runtimes,
+            )
+        self.store.finish(simulation.id, self.worker_id, simulation.status)
+
+    def _reap(self):
+        """Report the simulations whose local process has exited."""
+        with self._lock:
+            finished = [
+                simulation
+                for simulation in self._running.values()
+                if simulation.is_finished
+            ]
+            for simulation in finished:
+                del self._running[simulation.id]
+        for simulation in finished:
+            self._report(simulation)
+
+    def _claim(self):
+        """Start queued simulations in the free slots."""
+        for record in self.store.claim(self.worker_id, MAX_SIMULATIONS):
+            id = record["id"]
+            try:
+                simulation = Simulation(
+                    TransformationInput.parse_obj(record["parameters"]),
+                    id=id,
+                )
+                simulation.run()
+            except Exception:
+                logging.exception(f"Simulation '{id}' could not start.")
+                self.store.finish(
+                    id, self.worker_id, TransformationState.FAILED
+                )
+                continue
+            with self._lock:
+                self._running[id] = simulation
+
+    def _refresh_predictor(self):
+        """Refit the predictor if any worker recorded a new runtime."""
+        version = self.store.runtimes_version()
+        if version == self._predictor_version:
+            return
+        with self._predictor_lock:
+            if version != self._predictor_version:
+                self.predictor.fit(self.store.get_runtimes(RUNTIME_HISTORY))
+                self._predictor_version = version
+
+    def _get_backlog(self) -> tuple:
+        """Return the predicted runtimes of the running and queued simulations.
+
+        The result is cached until the backlog changes or the predictor is
+        refitted, so that polling does not rescan the backlog.
 
-        Raises:
-            KeyError: if there is no simulation matching the id
+        Returns:
+            tuple: start time and predicted runtime of each running
+                simulation, predicted work queued ahead and predicted runtime
+                of each queued simulation, and the total queued work
+        """
+        self._refresh_predictor()
+        key = (self.store.backlog_version(), self._predictor_version)
+        backlog = self._backlog
+        if backlog is None or backlog[0] != key:
+            running = {}
+            queued = {}
+            queued_work = 0.0
+            for record in self.store.get_backlog():
+                runtime = self.predictor.predict(record["parameters"], PHASES)
+                if record["started"] is None:
+                    queued[record["id"]] = (queued_work, runtime)
+                    queued_work += runtime
+                else:
+                    running[record["id"]] = (record["started"], runtime)
+            backlog = (key, running, queued, queued_work)
+            self._backlog = backlog
+        return backlog[1:]
+
+    def _estimate(self, id: Optional[str] = None) -> tuple:
+        """Estimate when a simulation would start and how long it would run.
+
+        The work ahead is the remaining predicted runtime of the running
+        simulations plus the runtime of the ones queued before the given
+        one, spread over the MAX_SIMULATIONS slots.
+
+        Args:
+            id (Optional[str]): simulation to estimate; if it is not in the
+                backlog, it is assumed to be queued now behind all of it
 
         Returns:
-            Simulation instance
+            tuple: predicted start as a UNIX timestamp, predicted runtime in
+                seconds of the simulation if it is in the backlog, otherwise
+                None
         """
-        try:
-            simulation = self.simulations[id]
-            return simulation
-        except KeyError as ke:
-            message = f"Simulation with id '{id}' not found"
-            logging.error(message)
-            raise KeyError(message) from ke
+        running, queued, queued_work = self._get_backlog()
+        if id in running:
+            return running[id]
+        now = time.time()
+        work = sum(
+            max(runtime - (now - started), 0.0)
+            for started, runtime in running.values()
+        )
+        if id in queued:
+            ahead, runtime = queued[id]
+            return now + (work + ahead) / MAX_SIMULATIONS, runtime
+        return now + (work + queued_work) / MAX_SIMULATIONS, None
+
+    def _check_admission(self):
+        """Refuse new work when the queue is too long.
 
-    def _add_simulation(self, simulation: Simulation) -> str:
-        """Append a simulation to the internal datastructure.
+        Raises:
+            QueueFullError: if the predicted wait exceeds MAX_QUEUE_WAIT
+        """
+        start, _ = self._estimate()
+        wait = start - time.time()
+        if wait > MAX_QUEUE_WAIT:
+            msg = (
+                f"Predicted queue wait of {wait:.0f} s exceeds the limit of "
+                f"{MAX_QUEUE_WAIT:.0f} s."
+            )
+            logging.warning(msg)
+            raise QueueFullError(msg, math.ceil(wait - MAX_QUEUE_WAIT))
+
+    def get_predicted_completion(self, id: str) -> Optional[datetime]:
+        """Predict when a simulation completes.
+
+        Simulations that were created but not started are assumed to be
+        queued now.
 
         Args:
-            simulation (Simulation): Object to add
+            id (str): unique simulation id
 
         Returns:
-            str: ID of the added object
+            Optional[datetime]: predicted completion time, None if the
+                simulation already finished
         """
-        id: str = simulation.id
-        self.simulations[id] = simulation
-        return id
-
-    def _delete_simulation(self, id: str):
-        """Remove a simulation from the internal datastructure.
+        record = self._get_record(id)
+        if record["state"] not in (
+            TransformationState.CREATED,
+            TransformationState.RUNNING,
+        ):
+            return None
+        start, runtime = self._estimate(id)
+        if runtime is None:
+            runtime = self.predictor.predict(record["parameters"], PHASES)
+        # A simulation running longer than predicted is expected to end soon
+        completion = max(start + runtime, time.time())
+        return datetime.fromtimestamp(completion, tz=timezone.utc)
+
+    def _get_record(self, id: str) -> dict:
+        """
+        Get the record of the simulation corresponding to the id.
 
         Args:
-            id (str): id of the simulation to remove
+            id (str): unique id of he simulation
+
+        Raises:
+            KeyError: if there is no simulation matching the id
+
+        Returns:
+            dict: id, parameters and state of the simulation
         """
-        del self.simulations[id]
+        try:
+            return self.store.get(id)
+        except KeyError as ke:
+            message = f"Simulation with id '{id}' not found"
+            logging.error(message)
+            raise KeyError(message) from ke
 
     def create_simulation(self, request_obj: TransformationInput) -> str:
         """Create a new simulation given the arguments.
@@ -56,10 +331,17 @@ class SimulationManager:
         Args:
            requestObj: dictionary containing input configuration
 
+        Raises:
+            QueueFullError: if the queue is too long to accept new work
+
         Returns:
             str: unique job id
         """
-        return self._add_simulation(Simulation(request_obj))
+        self._check_admission()
+        id = str(uuid.uuid4())
+        self.store.add(id, request_obj.dict())
+        logging.info(f"Simulation '{id}' with payload {request_obj} created.")
+        return id
 
     def get_simulation(self, id) -> dict:
         """Return information of one simulation.
@@ -70,37 +352,73 @@ class SimulationManager:
         Returns:
             list: list of simulation ids
         """
-        simulation = self._get_simulation(id)
-        return {
-            "id": simulation.id,
-            "parameters": simulation.parameters,
-            "state": simulation.status,
-        }
+        return self._get_record(id)
 
     def run_simulation(self, id):
-        """Execute a simulation.
+        """Queue a simulation for execution.
+
+        The simulation is claimed right away if there is a free slot.
 
         Args:
             id (str): unique simulation id
+
+        Raises:
+            RuntimeError: when the simulation is in progress or has finished
+            QueueFullError: if the queue is too long to accept new work
         """
-        self._get_simulation(id).run()
+        msg = f"Simulation '{id}' cannot be started."
+        if self._get_record(id)["state"] != TransformationState.CREATED:
+            logging.error(msg)
+            raise RuntimeError(msg)
+        # Only work that would actually be queued is subject to admission
+        self._check_admission()
+        if not self.store.transition(
+            id, TransformationState.RUNNING, (TransformationState.CREATED,)
+        ):
+            logging.error(msg)
+            raise RuntimeError(msg)
+        logging.info(f"Simulation '{id}' queued.")
+        self._claim()
 
     def stop_simulation(self, id: str) -> dict:
         """Force terminate a simulation.
 
+        The worker running the simulation terminates it on its next
+        heartbeat, or immediately if it is this worker.
+
         Args:
             id (str): unique id of the simulation
+
+        Raises:
+            RuntimeError: if the simulation is not running
         """
-        self._get_simulation(id).stop()
+        self._get_record(id)
+        if not self.store.transition(
+            id, TransformationState.STOPPED, (TransformationState.RUNNING,)
+        ):
+            msg = f"No process to stop. Is simulation '{id}' running?"
+            logging.error(msg)
+            raise RuntimeError(msg)
+        self._terminate(id)
+        logging.info(f"Simulation '{id}' stopped successfully.")
 
     def delete_simulation(self, id: str) -> dict:
         """Delete all the simulation information.
 
         Args:
             id (str): unique id of simulation
+
+        Raises:
+            RuntimeError: if deleting a running simulation
         """
-        self._get_simulation(id).delete()
-        self._delete_simulation(id)
+        self._get_record(id)
+        try:
+            self.store.delete(id)
+        except RuntimeError:
+            logging.error(f"Simulation '{id}' is running.")
+            raise
+        shutil.rmtree(self._get_simulation_path(id), ignore_errors=True)
+        logging.info(f"Simulation '{id}' and related files deleted.")
 
     def get_simulation_state(self, id: str):
         """Return the status of a particular simulation.
@@ -111,7 +429,16 @@ class SimulationManager:
         Returns:
             TransformationState: status of the simulation
         """
-        return self._get_simulation(id).status
+        try:
+            return self.store.get_state(id)
+        except KeyError as ke:
+            message = f"Simulation with id '{id}' not found"
+            logging.error(message)
+            raise KeyError(message) from ke
+
+    @staticmethod
+    def _get_simulation_path(id: str) -> Path:
+        return Path(SIMULATIONS_FOLDER_PATH, id)
 
     def get_simulation_output_path(self, id: str) -> str:
         """Get the path to a simulation's output.
@@ -122,21 +449,48 @@ class SimulationManager:
         Returns:
             str: path to the simulation output
         """
-        return self._get_simulation(id).get_output_path()
+        if self.get_simulation_state(id) == TransformationState.COMPLETED:
+            return self._get_simulation_path(id) / "results.zip"
 
-    def get_simulations(self) -> list:
-        """Return information of all simulations.
+    def iter_simulations_json(self) -> Iterator[str]:
+        """Return information of all simulations as a serialized response.
+
+        Every simulation is kept as a JSON fragment. When the shared state
+        changes, only the simulations changed or deleted since the cached
+        version are read again, and their stored parameters are spliced in
+        without being decoded. The document is streamed in chunks built from
+        the fragments, so it is never held in memory as a whole.
 
         Returns:
-            list: list of simulation ids
+            Iterator[str]: chunks of the JSON document with the list of
+                simulations
         """
-        items = []
-        for simulation in self.simulations.values():
-            items.append(
-                {
-                    "id": simulation.id,
-                    "parameters": simulation.parameters,
-                    "state": simulation.status,
-                }
-            )
-        return items
+        version = self.store.version()
+        with self._items_lock:
+            if version != self._items_version:
+                version, changed, deleted = self.store.get_changes(
+                    self._items_version
+                )
+                if deleted is None:
+                    self._items.clear()
+                else:
+                    for id in deleted:
+                        self._items.pop(id, None)
+                for record in changed:
+                    self._items[record["id"]] = (
+                        f'{{"id": {json.dumps(record["id"])}, '
+                        f'"parameters": {record["parameters"]}, '
+                        f'"state": {json.dumps(record["state"])}}}'
+                    )
+                self._items_version = version
+            # Only references to the fragments are copied
+            items = list(self._items.values())
+        return self._iter_json(items)
+
+    @staticmethod
+    def _iter_json(items: list) -> Iterator[str]:
+        yield '{"items": ['
+        for start in range(0, len(items), LIST_CHUNK_SIZE):
+            separator = ", " if start else ""
+            yield separator + ", ".join(items[start : start + LIST_CHUNK_SIZE])
+        yield "]}"
@@ -0,0 +1,539 @@
+"""Simulation records and job leases shared by all API workers."""
+
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+from marketplace_standard_app_api.models.transformation import (
+    TransformationState,
+)
+
+STATE_DB_PATH = "/root/app/simulation_files/state.db"
+LEASE_DURATION = 30.0
+# Seconds for which deleted ids are remembered for incremental readers
+DELETION_RETENTION = 24 * 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS simulations (
+    id TEXT PRIMARY KEY,
+    parameters TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    started REAL,
+    created REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS simulations_claim
+    ON simulations (state, lease_expires);
+CREATE INDEX IF NOT EXISTS simulations_version ON simulations (version);
+CREATE TABLE IF NOT EXISTS deletions (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    deleted REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runtimes (
+    parameters TEXT NOT NULL,
+    phases TEXT NOT NULL,
+    runtimes TEXT NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('backlog', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('pruned', 0);
+"""
+
+
+class SimulationStore:
+    """SQLite backed storage of the simulations.
+
+    Every API worker opens the same database file, so any worker can answer
+    for any simulation. The workers must run on the same host: the database
+    uses WAL mode, which relies on shared memory and does not work on
+    network filesystems, and leases compare timestamps taken by the workers'
+    clocks. Running a simulation is coordinated through leases:
+    a worker claims a job by writing its id and a lease expiry into the row
+    and must renew the lease while the job runs. Jobs whose lease expires,
+    e.g. because their worker crashed, become claimable again.
+
+    A version counter is bumped on every change so that workers can cache
+    derived data and cheaply detect when it is stale. Each row, and each
+    deleted id, is stamped with the version of its last change so that a
+    cache can be brought up to date by reading only what changed since.
+    Deleted ids are kept for DELETION_RETENTION; a cache older than that is
+    rebuilt from scratch. A second counter only tracks changes to the
+    backlog of running and queued simulations.
+    """
+
+    def __init__(
+        self, path: str = STATE_DB_PATH, lease_duration: float = LEASE_DURATION
+    ):
+        self.path = path
+        self.lease_duration = lease_duration
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the calling thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed statements in one write transaction."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _bump_version(connection: sqlite3.Connection, id: str):
+        """Increase the version and stamp the changed simulation with it."""
+        connection.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'version'"
+        )
+        connection.execute(
+            "UPDATE simulations SET version = "
+            "(SELECT value FROM meta WHERE key = 'version') WHERE id = ?",
+            (id,),
+        )
+
+    @staticmethod
+    def _bump_backlog_version(connection: sqlite3.Connection):
+        connection.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'backlog'"
+        )
+
+    @staticmethod
+    def _to_record(row: sqlite3.Row) -> dict:
+        return {
+            "id": row["id"],
+            "parameters": json.loads(row["parameters"]),
+            "state": TransformationState(row["state"]),
+        }
+
+    def add(self, id: str, parameters: dict):
+        """Register a new simulation in the CREATED state.
+
+        Args:
+            id (str): unique id of the simulation
+            parameters (dict): input of the simulation
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO simulations (id, parameters, state, created) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    id,
+                    json.dumps(parameters),
+                    TransformationState.CREATED.value,
+                    time.time(),
+                ),
+            )
+            self._bump_version(connection, id)
+
+    def get(self, id: str) -> dict:
+        """Return the record of a simulation.
+
+        Args:
+            id (str): unique id of the simulation
+
+        Raises:
+            KeyError: if there is no simulation matching the id
+
+        Returns:
+            dict: id, parameters and state of the simulation
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT id, parameters, state FROM simulations WHERE id = ?",
+                (id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(id)
+        return self._to_record(row)
+
+    def get_state(self, id: str) -> TransformationState:
+        """Return the state of a simulation.
+
+        Args:
+            id (str): unique id of the simulation
+
+        Raises:
+            KeyError: if there is no simulation matching the id
+
+        Returns:
+            TransformationState: state of the simulation
+        """
+        row = (
+            self._connection()
+            .execute("SELECT state FROM simulations WHERE id = ?", (id,))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(id)
+        return TransformationState(row["state"])
+
+    def version(self) -> int:
+        """Return the current version of the stored data."""
+        return (
+            self._connection()
+            .execute("SELECT value FROM meta WHERE key = 'version'")
+            .fetchone()[0]
+        )
+
+    def get_changes(self, since: int) -> tuple:
+        """Return what changed after a given version.
+
+        The parameters are returned as stored, i.e. as JSON text, so callers
+        that only forward them do not need to decode them. If deletions after
+        the given version were already pruned, every simulation is returned
+        and the deleted ids are None.
+
+        Args:
+            since (int): version the caller is up to date with, 0 for all
+
+        Returns:
+            tuple: current version, id, JSON parameters and state of the
+                changed simulations in creation order, and the deleted ids,
+                or None if the caller must drop what it has
+        """
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            version = self.version()
+            pruned = connection.execute(
+                "SELECT value FROM meta WHERE key = 'pruned'"
+            ).fetchone()[0]
+            if since < pruned:
+                since = 0
+            rows = connection.execute(
+                "SELECT id, parameters, state FROM simulations "
+                "WHERE version > ? ORDER BY created",
+                (since,),
+            ).fetchall()
+            deleted = connection.execute(
+                "SELECT id FROM deletions WHERE version > ?", (since,)
+            ).fetchall()
+        finally:
+            connection.execute("COMMIT")
+        if not since:
+            deleted = None
+        changed = [
+            {
+                "id": row["id"],
+                "parameters": row["parameters"],
+                "state": TransformationState(row["state"]),
+            }
+            for row in rows
+        ]
+        if deleted is not None:
+            deleted = [row["id"] for row in deleted]
+        return version, changed, deleted
+
+    def transition(
+        self,
+        id: str,
+        state: TransformationState,
+        expected: Iterable[TransformationState],
+    ) -> bool:
+        """Change the state of a simulation if it is in an expected state.
+
+        Moving to any state releases the lease held on the simulation.
+
+        Args:
+            id (str): unique id of the simulation
+            state (TransformationState): new state
+            expected (Iterable[TransformationState]): allowed current states
+
+        Raises:
+            KeyError: if there is no simulation matching the id
+
+        Returns:
+            bool: whether the state was changed
+        """
+        expected = [value.value for value in expected]
+        placeholders = ", ".join("?" * len(expected))
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE simulations SET state = ?, owner = NULL, "
+                "lease_expires = 0, started = NULL "
+                f"WHERE id = ? AND state IN ({placeholders})",
+                (state.value, id, *expected),
+            )
+            if cursor.rowcount:
+                self._bump_version(connection, id)
+                self._bump_backlog_version(connection)
+                return True
+            if not connection.execute(
+                "SELECT 1 FROM simulations WHERE id = ?", (id,)
+            ).fetchone():
+                raise KeyError(id)
+            return False
+
+    def delete(self, id: str):
+        """Remove a simulation that is not running.
+
+        Deleted ids older than DELETION_RETENTION are pruned at the same time.
+
+        Args:
+            id (str): unique id of the simulation
+
+        Raises:
+            KeyError: if there is no simulation matching the id
+            RuntimeError: if the simulation is running
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT state FROM simulations WHERE id = ?", (id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(id)
+            if row["state"] == TransformationState.RUNNING.value:
+                raise RuntimeError(f"Simulation '{id}' is running.")
+            connection.execute("DELETE FROM simulations WHERE id = ?", (id,))
+            self._bump_version(connection, id)
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO deletions (id, version, deleted) "
+                "SELECT ?, value, ? FROM meta WHERE key = 'version'",
+                (id, now),
+            )
+            horizon = now - DELETION_RETENTION
+            connection.execute(
+                "UPDATE meta SET value = MAX(value, (SELECT "
+                "COALESCE(MAX(version), 0) FROM deletions WHERE deleted < ?)) "
+                "WHERE key = 'pruned'",
+                (horizon,),
+            )
+            connection.execute(
+                "DELETE FROM deletions WHERE deleted < ?", (horizon,)
+            )
+
+    def claim(self, owner: str, limit: int) -> list:
+        """Take the lease of running simulations that have no live owner.
+
+        The limit is shared by all the workers: no more simulations are
+        claimed than the limit minus the ones other workers already hold.
+
+        Args:
+            owner (str): id of the claiming worker
+            limit (int): maximum number of simulations running at once
+
+        Returns:
+            list: records of the claimed simulations
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            held = connection.execute(
+                "SELECT COUNT(*) FROM simulations "
+                "WHERE state = ? AND lease_expires >= ?",
+                (TransformationState.RUNNING.value, now),
+            ).fetchone()[0]
+            limit -= held
+            if limit <= 0:
+                return []
+            rows = connection.execute(
+                "SELECT id, parameters, state FROM simulations "
+                "WHERE state = ? AND lease_expires < ? "
+                "ORDER BY created LIMIT ?",
+                (TransformationState.RUNNING.value, now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE simulations SET owner = ?, lease_expires = ?, "
+                "started = ? WHERE id = ?",
+                [
+                    (owner, now + self.lease_duration, now, row["id"])
+                    for row in rows
+                ],
+            )
+            if rows:
+                self._bump_backlog_version(connection)
+        return [self._to_record(row) for row in rows]
+
+    def renew(self, owner: str, ids: Iterable[str]) -> set:
+        """Extend the leases a worker holds.
+
+        Args:
+            owner (str): id of the worker
+            ids (Iterable[str]): simulations the worker is running
+
+        Returns:
+            set: ids whose lease is still held by the worker; the others
+                were stopped, deleted or claimed by another worker
+        """
+        ids = list(ids)
+        if not ids:
+            return set()
+        placeholders = ", ".join("?" * len(ids))
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE simulations SET lease_expires = ? "
+                f"WHERE owner = ? AND state = ? AND id IN ({placeholders})",
+                (
+                    time.time() + self.lease_duration,
+                    owner,
+                    TransformationState.RUNNING.value,
+                    *ids,
+                ),
+            )
+            rows = connection.execute(
+                "SELECT id FROM simulations "
+                f"WHERE owner = ? AND state = ? AND id IN ({placeholders})",
+                (owner, TransformationState.RUNNING.value, *ids),
+            ).fetchall()
+        return {row["id"] for row in rows}
+
+    def finish(self, id: str, owner: str, state: TransformationState):
+        """Record the outcome of a simulation run by a worker.
+
+        Nothing changes if the worker no longer holds the lease, e.g. because
+        the simulation was stopped in the meantime.
+
+        Args:
+            id (str): unique id of the simulation
+            owner (str): id of the worker that ran the simulation
+            state (TransformationState): final state of the simulation
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE simulations SET state = ?, owner = NULL, "
+                "lease_expires = 0 WHERE id = ? AND owner = ? AND state = ?",
+                (state.value, id, owner, TransformationState.RUNNING.value),
+            )
+            if cursor.rowcount:
+                self._bump_version(connection, id)
+                self._bump_backlog_version(connection)
+
+    def release(self, owner: str, ids: Optional[Iterable[str]] = None):
+        """Give up leases so that other workers can claim the jobs again.
+
+        Args:
+            owner (str): id of the worker
+            ids (Optional[Iterable[str]]): simulations to release, all the
+                ones held by the worker if not given
+        """
+        query = (
+            "UPDATE simulations SET owner = NULL, lease_expires = 0, "
+            "started = NULL WHERE owner = ?"
+        )
+        parameters = [owner]
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return
+            query += f" AND id IN ({', '.join('?' * len(ids))})"
+            parameters += ids
+        with self._transaction() as connection:
+            if connection.execute(query, parameters).rowcount:
+                self._bump_backlog_version(connection)
+
+    def backlog_version(self) -> int:
+        """Return a number that changes whenever the backlog changes."""
+        return (
+            self._connection()
+            .execute("SELECT value FROM meta WHERE key = 'backlog'")
+            .fetchone()[0]
+        )
+
+    def get_backlog(self) -> list:
+        """Return the simulations that are running or waiting to run.
+
+        Returns:
+            list: id, parameters and start time (None while queued) of each
+                simulation, in creation order
+        """
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT id, parameters, started FROM simulations "
+                "WHERE state = ? ORDER BY created",
+                (TransformationState.RUNNING.value,),
+            )
+            .fetchall()
+        )
+        return [
+            {
+                "id": row["id"],
+                "parameters": json.loads(row["parameters"]),
+                "started": row["started"],
+            }
+            for row in rows
+        ]
+
+    def add_runtime(self, parameters: dict, phases: list, runtimes: dict):
+        """Record how long each calculation of a simulation took.
+
+        Args:
+            parameters (dict): input of the simulation
+            phases (list): phases selected for the calculation
+            runtimes (dict): runtime in seconds of each calculation
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO runtimes (parameters, phases, runtimes, finished) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    json.dumps(parameters),
+                    json.dumps(phases),
+                    json.dumps(runtimes),
+                    time.time(),
+                ),
+            )
+
+    def runtimes_version(self) -> int:
+        """Return a number that changes whenever a runtime is recorded."""
+        return (
+            self._connection()
+            .execute("SELECT COALESCE(MAX(rowid), 0) FROM runtimes")
+            .fetchone()[0]
+        )
+
+    def get_runtimes(self, limit: int) -> list:
+        """Return the most recently recorded runtimes.
+
+        Args:
+            limit (int): maximum number of records
+
+        Returns:
+            list: parameters, phases and runtimes of each record
+        """
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT parameters, phases, runtimes FROM runtimes "
+                "ORDER BY rowid DESC LIMIT ?",
+                (limit,),
+            )
+            .fetchall()
+        )
+        return [
+            {
+                "parameters": json.loads(row["parameters"]),
+                "phases": json.loads(row["phases"]),
+                "runtimes": json.loads(row["runtimes"]),
+            }
+            for row in rows
+        ]
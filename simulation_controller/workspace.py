@@ -0,0 +1,85 @@
+"""Private scratch directories for MatCalc calculations."""
+
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+TMPFS_PATH = Path("/dev/shm")
+
+
+def get_scratch_root() -> Optional[str]:
+    """Return the folder in which scratch directories are created.
+
+    tmpfs is preferred so intermediate files never touch the disk. If it is
+    not available, the platform's default temporary folder is used.
+
+    Returns:
+        Optional[str]: path to the tmpfs mount, or None for the default
+    """
+    if TMPFS_PATH.is_dir() and os.access(TMPFS_PATH, os.W_OK):
+        return str(TMPFS_PATH)
+    return None
+
+
+class Workspace:
+    """Scratch directory owned by a single calculation.
+
+    Used as a context manager: the directory is created on entry and removed
+    on exit, whether the calculation succeeded, failed or was cancelled.
+    Only files handed to `promote` outlive the workspace.
+    """
+
+    def __init__(
+        self,
+        destination: Path,
+        prefix: str = "matcalc-",
+        root: Optional[str] = None,
+    ):
+        self.destination = Path(destination)
+        self.prefix = prefix
+        self.root = root if root is not None else get_scratch_root()
+        self.path: Optional[Path] = None
+
+    def __enter__(self) -> "Workspace":
+        self.path = Path(tempfile.mkdtemp(prefix=self.prefix, dir=self.root))
+        logging.debug(f"Workspace '{self.path}' created.")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def cleanup(self):
+        """Remove the scratch directory and everything left in it."""
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            logging.debug(f"Workspace '{self.path}' removed.")
+            self.path = None
+
+    def promote(self, file: Union[str, Path]) -> Path:
+        """Move a finished artifact to persistent storage.
+
+        The file is first copied next to its target under a temporary name
+        and then renamed, so readers never see a partially written artifact.
+
+        Args:
+            file (Union[str, Path]): file inside the workspace
+
+        Returns:
+            Path: location of the artifact in persistent storage
+        """
+        source = Path(file)
+        target = self.destination / source.name
+        partial = self.destination / f".{source.name}.part"
+        try:
+            shutil.copyfile(source, partial)
+            os.replace(partial, target)
+        except BaseException:
+            # Also reached on termination, which raises SystemExit
+            partial.unlink(missing_ok=True)
+            raise
+        os.remove(source)
+        return target